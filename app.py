@@ -1,9 +1,18 @@
+import asyncio
+import collections
+import csv
+import io
+import itertools
 import os
+import queue
+import re
 import smtplib
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from contextlib import contextmanager
 from datetime import datetime
 
 import pandas as pd
@@ -21,110 +30,627 @@ SMTP_PASS = os.getenv("SMTP_PASS")
 FROM_EMAIL = os.getenv("FROM_EMAIL", SMTP_USER or "demo@example.com")
 FROM_NAME = os.getenv("FROM_NAME", "Mini-Brevo Demo")
 
+# Conexiones SMTP simultáneas (Gmail admite ~15, Zoho ~5)
+SMTP_CONCURRENCY = max(1, int(os.getenv("SMTP_CONCURRENCY", "5")))
+# Si la sesión lleva más de estos segundos sin usarse, se comprueba con NOOP antes de enviar
+SMTP_IDLE_NOOP_SECS = 30
+# Envíos en vuelo por hilo del pool: acota la memoria de cuerpos personalizados
+SMTP_INFLIGHT_PER_WORKER = 4
+# Relays SMTP ("host" o "host:puerto", separados por coma). Si se define, sustituye a
+# SMTP_HOST; con más de un relay los envíos masivos se reparten entre todos.
+SMTP_HOSTS = [h.strip() for h in os.getenv("SMTP_HOSTS", "").split(",") if h.strip()]
+
+LOG_BATCH_SIZE = 1000
+JOB_PROGRESS_EVERY = 100
+JOB_FINAL_STATUSES = ("DONE", "ERROR")
+CONTACTS_PAGE_SIZE = 100
+RECIPIENT_PICKER_LIMIT = 500
+IMPORT_CHUNK_SIZE = 10000
+
+DB_BUSY_TIMEOUT_SECS = 60
+
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
 # -------------- DB Helpers ------------
 
-@contextmanager
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    try:
-        yield conn
-    finally:
-        conn.close()
+def connect_db():
+    # timeout = busy timeout de SQLite: el worker y la UI escriben a la vez y una
+    # importación grande retiene el bloqueo de escritura durante toda su transacción
+    conn = sqlite3.connect(
+        DB_PATH, timeout=DB_BUSY_TIMEOUT_SECS, check_same_thread=False, isolation_level=None
+    )
+    # WAL + synchronous=NORMAL: sin fsync por commit (seguro ante caídas de la app)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=134217728")
+    return conn
+
+def get_db():
+    # Una conexión por sesión, guardada en session_state: no se reabre en cada rerun
+    # y los BEGIN/COMMIT de una sesión no se mezclan con los de otra.
+    conn = st.session_state.get("db_conn")
+    if conn is None:
+        conn = st.session_state["db_conn"] = connect_db()
+    return conn
 
 def init_db():
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                email TEXT UNIQUE,
-                tags TEXT,
-                created_at TEXT
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS campaigns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subject TEXT,
-                body TEXT,
-                created_at TEXT
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sends (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                campaign_id INTEGER,
-                contact_id INTEGER,
-                email TEXT,
-                status TEXT,
-                error TEXT,
-                sent_at TEXT
-            )
-        """)
-        conn.commit()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            email TEXT UNIQUE,
+            tags TEXT,
+            created_at TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject TEXT,
+            body TEXT,
+            created_at TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sends (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER,
+            contact_id INTEGER,
+            email TEXT,
+            status TEXT,
+            error TEXT,
+            sent_at TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER,
+            status TEXT,
+            total INTEGER,
+            processed INTEGER,
+            sent_ok INTEGER,
+            error TEXT,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sends_campaign ON sends(campaign_id)")
+
+@st.cache_resource
+def init_db_once():
+    # El DDL se ejecuta una vez por proceso del servidor, no en cada rerun
+    init_db()
+    return True
 
 def insert_contact(name, email, tags):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO contacts(name, email, tags, created_at) VALUES (?,?,?,?)",
-            (name.strip(), email.strip().lower(), tags.strip(), datetime.utcnow().isoformat())
-        )
-        conn.commit()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT OR IGNORE INTO contacts(name, email, tags, created_at) VALUES (?,?,?,?)",
+        (name.strip(), email.strip().lower(), tags.strip(), datetime.utcnow().isoformat())
+    )
 
-def bulk_import_contacts(df: pd.DataFrame):
-    count = 0
-    for _, row in df.iterrows():
-        name = str(row.get("name", "")).strip()
-        email = str(row.get("email", "")).strip().lower()
-        tags = str(row.get("tags", "")).strip()
-        if email:
-            try:
-                insert_contact(name, email, tags)
-                count += 1
-            except Exception:
-                pass
-    return count
+def bulk_import_contacts(file):
+    # Lee el CSV en streaming (csv.DictReader) y lo inserta por tandas: memoria
+    # O(IMPORT_CHUNK_SIZE) en lugar de cargar el archivo completo en un DataFrame.
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.DictReader(text)
+        if reader.fieldnames:
+            reader.fieldnames = [f.strip().lower() for f in reader.fieldnames]
+        now = datetime.utcnow().isoformat()
+        inserted = 0
+        rejected = 0
+
+        # Una sola transacción para todo el CSV (un único commit / fsync)
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            while True:
+                chunk = list(itertools.islice(reader, IMPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                rows = [
+                    ((r.get("name") or "").strip(), (r.get("email") or "").strip().lower(),
+                     (r.get("tags") or "").strip(), now)
+                    for r in chunk if (r.get("email") or "").strip()
+                ]
+                valid = [row for row in rows if EMAIL_RE.match(row[1])]
+                rejected += len(rows) - len(valid)
+                cur.executemany(
+                    "INSERT OR IGNORE INTO contacts(name, email, tags, created_at) VALUES (?,?,?,?)",
+                    valid
+                )
+                inserted += cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return inserted, rejected
+    finally:
+        # No cerrar el archivo subido al liberar el wrapper
+        text.detach()
 
 def insert_campaign(subject, body):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO campaigns(subject, body, created_at) VALUES (?,?,?)",
-            (subject.strip(), body, datetime.utcnow().isoformat())
-        )
-        conn.commit()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO campaigns(subject, body, created_at) VALUES (?,?,?) RETURNING id",
+        (subject.strip(), body, datetime.utcnow().isoformat())
+    )
+    return cur.fetchone()[0]
 
 def log_send(campaign_id, contact_id, email, status, error=""):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO sends(campaign_id, contact_id, email, status, error, sent_at) VALUES (?,?,?,?,?,?)",
+        (campaign_id, contact_id, email, status, error, datetime.utcnow().isoformat())
+    )
+
+def log_sends(rows, conn=None):
+    # rows: tuplas (campaign_id, contact_id, email, status, error, sent_at)
+    if not rows:
+        return
+    conn = conn or get_db()
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        cur.executemany(
             "INSERT INTO sends(campaign_id, contact_id, email, status, error, sent_at) VALUES (?,?,?,?,?,?)",
-            (campaign_id, contact_id, email, status, error, datetime.utcnow().isoformat())
+            rows
         )
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def load_recipients(contact_ids, conn=None):
+    # (id, email, name) de los contactos indicados; IN por tandas para no
+    # superar el límite de parámetros de SQLite
+    conn = conn or get_db()
+    contact_ids = list(contact_ids)
+    rows = []
+    for start in range(0, len(contact_ids), 500):
+        chunk = contact_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows.extend(conn.execute(
+            f"SELECT id, email, name FROM contacts WHERE id IN ({placeholders})", chunk
+        ).fetchall())
+    return rows
+
+def insert_job(campaign_id, total):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO jobs(campaign_id, status, total, processed, sent_ok, error, created_at) "
+        "VALUES (?,?,?,?,?,?,?) RETURNING id",
+        (campaign_id, "QUEUED", total, 0, 0, "", datetime.utcnow().isoformat())
+    )
+    return cur.fetchone()[0]
+
+def load_job(job_id):
+    return get_db().execute(
+        "SELECT status, total, processed, sent_ok, error FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+
+def db_mtime():
+    # Marca de frescura barata: en modo WAL los commits tocan el archivo -wal
+    # antes que la base principal, así que se toma el más reciente de ambos.
+    wal_path = DB_PATH + "-wal"
+    mtime = os.path.getmtime(DB_PATH)
+    if os.path.exists(wal_path):
+        mtime = max(mtime, os.path.getmtime(wal_path))
+    return mtime
+
+@st.cache_data(ttl=5)
+def count_contacts(mtime):
+    return get_db().execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+@st.cache_data(ttl=60)
+def load_contacts_page(mtime, page):
+    # El ORDER BY id DESC LIMIT/OFFSET recorre el B-tree de la PK: O(tamaño de página)
+    return pd.read_sql_query(
+        "SELECT * FROM contacts ORDER BY id DESC LIMIT ? OFFSET ?", get_db(),
+        params=(CONTACTS_PAGE_SIZE, page * CONTACTS_PAGE_SIZE),
+        dtype_backend="pyarrow"
+    )
+
+def tags_filter(tags):
+    # WHERE para "tiene alguna de estas etiquetas" sobre la columna CSV tags.
+    # Se comparan sin espacios y rodeadas de comas para no confundir "vip" con "vipx".
+    if not tags:
+        return "", []
+    cond = " OR ".join(["instr(',' || REPLACE(IFNULL(tags, ''), ' ', '') || ',', ?) > 0"] * len(tags))
+    return f" WHERE {cond}", [f",{t.replace(' ', '')}," for t in tags]
+
+@st.cache_data(ttl=60)
+def load_tags(mtime):
+    rows = get_db().execute("SELECT DISTINCT tags FROM contacts WHERE tags <> ''").fetchall()
+    return sorted({t.strip() for (tags,) in rows for t in tags.split(",") if t.strip()})
+
+@st.cache_data(ttl=60)
+def count_targets(mtime, tags):
+    where, params = tags_filter(tags)
+    return get_db().execute(f"SELECT COUNT(*) FROM contacts{where}", params).fetchone()[0]
+
+@st.cache_data(ttl=60)
+def load_target_ids(mtime, tags):
+    where, params = tags_filter(tags)
+    return [cid for (cid,) in get_db().execute(f"SELECT id FROM contacts{where} ORDER BY id DESC", params)]
+
+@st.cache_data(ttl=60)
+def load_target_labels(mtime, tags):
+    # Acotado: la selección manual no debe mandar al frontend toda la lista
+    where, params = tags_filter(tags)
+    rows = get_db().execute(
+        f"SELECT id, email, name FROM contacts{where} ORDER BY id DESC LIMIT ?",
+        [*params, RECIPIENT_PICKER_LIMIT]
+    )
+    return {cid: f"{email} ({name})" if name else email for cid, email, name in rows}
+
+@st.cache_data(ttl=60)
+def load_campaigns(mtime):
+    return pd.read_sql_query("SELECT * FROM campaigns ORDER BY id DESC", get_db())
+
+@st.cache_data(ttl=60)
+def load_sends(mtime):
+    # Columnas Arrow tipadas: st.dataframe las serializa sin conversión object -> Arrow
+    return pd.read_sql_query(
+        "SELECT s.id, s.sent_at, s.status, s.error, s.email, c.subject "
+        "FROM sends s LEFT JOIN campaigns c ON s.campaign_id = c.id "
+        "ORDER BY s.id DESC LIMIT 500", get_db(),
+        dtype_backend="pyarrow",
+        parse_dates={"sent_at": {"format": "ISO8601"}}
+    )
 
 # -------------- Email Sender ----------
+def parse_relay(relay):
+    host, _, port = relay.partition(":")
+    return host, int(port) if port else SMTP_PORT
+
+def smtp_relays():
+    if SMTP_HOSTS:
+        return [parse_relay(r) for r in SMTP_HOSTS]
+    return [(SMTP_HOST, SMTP_PORT)] if SMTP_HOST else []
+
+def smtp_configured():
+    return bool(smtp_relays() and SMTP_USER and SMTP_PASS and FROM_EMAIL)
+
+def build_message(to_email: str, subject: str, body_html: str):
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = subject
+    msg["From"] = f"{FROM_NAME} <{FROM_EMAIL}>"
+    msg["To"] = to_email
+
+    part_html = MIMEText(body_html, "html", "utf-8")
+    msg.attach(part_html)
+    return msg
+
+def open_smtp():
+    host, port = smtp_relays()[0]
+    server = smtplib.SMTP(host, port)
+    try:
+        server.starttls()
+        server.login(SMTP_USER, SMTP_PASS)
+    except Exception:
+        # No dejar el socket abierto si falla STARTTLS o el login
+        server.close()
+        raise
+    return server
+
+class ReusableMessage:
+    # Reutiliza el mismo MIMEMultipart: solo se cambian To/Subject, y la parte
+    # HTML (ya codificada) únicamente se reconstruye si el cuerpo cambia.
+
+    def __init__(self):
+        self._msg = None
+        self._body = None
+
+    def get(self, to_email, subject, body_html):
+        if self._msg is None:
+            self._msg = build_message(to_email, subject, body_html)
+            self._body = body_html
+            return self._msg
+        if body_html != self._body:
+            self._msg.set_payload([MIMEText(body_html, "html", "utf-8")])
+            self._body = body_html
+        self._msg.replace_header("To", to_email)
+        self._msg.replace_header("Subject", subject)
+        return self._msg
+
+class SmtpSender:
+    # Sesión SMTP reutilizable: conecta una vez (STARTTLS + LOGIN) y envía N correos.
+    # Si el servidor corta la conexión, reconecta y reintenta ese envío.
+
+    def __init__(self):
+        self.server = None
+        self.last_used = 0.0
+        self.auth_error = None
+        self._message = ReusableMessage()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def _reconnect(self):
+        self.close()
+        self.server = open_smtp()
+
+    def _sendmail(self, to_email, msg):
+        if self.server is None:
+            self.server = open_smtp()
+        elif time.monotonic() - self.last_used > SMTP_IDLE_NOOP_SECS:
+            # Solo tras un rato inactiva: si el servidor la cerró, NOOP lanza
+            # SMTPServerDisconnected y send() reconecta
+            self.server.noop()
+        self.server.sendmail(FROM_EMAIL, [to_email], msg.as_bytes())
+        self.last_used = time.monotonic()
+
+    def send(self, to_email: str, subject: str, body_html: str):
+        if not smtp_configured():
+            return True, "SIMULATED"
+        if self.auth_error:
+            # Credenciales rechazadas: no repetir un login fallido por cada destinatario
+            return False, self.auth_error
+        try:
+            msg = self._message.get(to_email, subject, body_html)
+            try:
+                self._sendmail(to_email, msg)
+            except smtplib.SMTPServerDisconnected:
+                self._reconnect()
+                self._sendmail(to_email, msg)
+            return True, ""
+        except smtplib.SMTPAuthenticationError as e:
+            self.auth_error = str(e)
+            return False, self.auth_error
+        except Exception as e:
+            return False, str(e)
+
 def send_email_smtp(to_email: str, subject: str, body_html: str):
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASS and FROM_EMAIL):
-        return True, "SIMULATED"
+    with SmtpSender() as sender:
+        return sender.send(to_email, subject, body_html)
+
+def send_bulk_smtp(messages):
+    # messages: iterable (idealmente generador) de tuplas (to_email, subject, body_html).
+    # Genera (ok, err) en el mismo orden.
+    if smtp_configured() and len(smtp_relays()) > 1:
+        yield from stream_bulk_async(messages)
+        return
+
+    if not smtp_configured() or SMTP_CONCURRENCY == 1:
+        with SmtpSender() as sender:
+            for to_email, subject, body_html in messages:
+                yield sender.send(to_email, subject, body_html)
+        return
+
+    # Cada hilo del pool usa su propio SmtpSender (una sesión SMTP por hilo)
+    local = threading.local()
+    senders = []
+    lock = threading.Lock()
+
+    def send_one(item):
+        sender = getattr(local, "sender", None)
+        if sender is None:
+            sender = local.sender = SmtpSender()
+            with lock:
+                senders.append(sender)
+        return sender.send(*item)
+
+    # Ventana acotada de envíos en vuelo en lugar de executor.map, que encola
+    # todos los mensajes (y sus cuerpos) de golpe
+    window = SMTP_CONCURRENCY * SMTP_INFLIGHT_PER_WORKER
     try:
-        msg = MIMEMultipart("alternative")
-        msg["Subject"] = subject
-        msg["From"] = f"{FROM_NAME} <{FROM_EMAIL}>"
-        msg["To"] = to_email
-
-        part_html = MIMEText(body_html, "html", "utf-8")
-        msg.attach(part_html)
-
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(FROM_EMAIL, [to_email], msg.as_string())
-        return True, ""
-    except Exception as e:
-        return False, str(e)
+        with ThreadPoolExecutor(max_workers=SMTP_CONCURRENCY) as executor:
+            pending = collections.deque()
+            for item in messages:
+                pending.append(executor.submit(send_one, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for sender in senders:
+            sender.close()
+
+def stream_bulk_async(messages):
+    # Corre send_bulk_async en un hilo auxiliar con su propio event loop y va
+    # devolviendo (ok, err) en orden a medida que terminan, igual que el pool de
+    # hilos: así el progreso del job y el volcado de logs por lotes siguen funcionando.
+    done = queue.Queue()
+    stop = threading.Event()
+
+    def run():
+        try:
+            asyncio.run(send_bulk_async(messages, lambda i, result: done.put((i, result)), stop))
+        except BaseException as e:
+            done.put((None, e))
+        finally:
+            done.put(None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    # Solo se guardan los resultados que llegan antes que alguno anterior (acotado
+    # por los envíos en vuelo)
+    early = {}
+    next_i = 0
+    try:
+        while True:
+            item = done.get()
+            if item is None:
+                break
+            i, result = item
+            if i is None:
+                raise result
+            early[i] = result
+            while next_i in early:
+                yield early.pop(next_i)
+                next_i += 1
+    finally:
+        # Si quien consume se detiene (p. ej. fallo al escribir logs), no seguir enviando
+        stop.set()
+        thread.join()
+
+async def send_bulk_async(messages, emit, stop):
+    # Varios relays: SMTP_CONCURRENCY sesiones aiosmtplib por relay, todas tomando
+    # mensajes de una misma cola acotada. Los relays más rápidos absorben más
+    # trabajo y un dominio grande (p. ej. gmail.com) no queda en una sola sesión.
+    import aiosmtplib
+
+    relays = smtp_relays()
+    n_workers = len(relays) * SMTP_CONCURRENCY
+    pending = asyncio.Queue(maxsize=n_workers * SMTP_INFLIGHT_PER_WORKER)
+    alive = n_workers
+
+    async def worker(host, port):
+        nonlocal alive
+        message = ReusableMessage()
+        smtp = None
+
+        async def connect():
+            client = aiosmtplib.SMTP(
+                hostname=host, port=port, username=SMTP_USER, password=SMTP_PASS, start_tls=True
+            )
+            await client.connect()
+            return client
+
+        try:
+            while True:
+                item = await pending.get()
+                i, (to_email, subject, body_html) = item
+                if smtp is None:
+                    try:
+                        smtp = await connect()
+                    except Exception as e:
+                        # Relay caído: la sesión se retira y devuelve el mensaje a la
+                        # cola para otra sesión; la última en pie sí lo marca como error.
+                        if alive > 1:
+                            alive -= 1
+                            await pending.put(item)
+                            pending.task_done()
+                            return
+                        emit(i, (False, str(e)))
+                        pending.task_done()
+                        continue
+                try:
+                    msg = message.get(to_email, subject, body_html).as_bytes()
+                    try:
+                        await smtp.sendmail(FROM_EMAIL, [to_email], msg)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        smtp = await connect()
+                        await smtp.sendmail(FROM_EMAIL, [to_email], msg)
+                    emit(i, (True, ""))
+                except Exception as e:
+                    emit(i, (False, str(e)))
+                pending.task_done()
+        finally:
+            if smtp is not None:
+                try:
+                    await smtp.quit()
+                except Exception:
+                    pass
+
+    workers = [
+        asyncio.create_task(worker(host, port))
+        for host, port in relays for _ in range(SMTP_CONCURRENCY)
+    ]
+    # Los cuerpos se generan a medida que hay hueco en la cola
+    for item in enumerate(messages):
+        if stop.is_set():
+            break
+        await pending.put(item)
+    await pending.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+# -------------- Templates -------------
+def compile_template(body: str):
+    # Parte el cuerpo UNA vez por campaña alrededor de {{name}}; luego cada
+    # destinatario es un join de los trozos, sin re-escanear el HTML completo.
+    parts = body.split("{{name}}")
+    return lambda name: (name or "").join(parts)
+
+# -------------- Background Jobs -------
+def run_send_job(conn, job_id, campaign_id, recipient_ids):
+    subject, body = conn.execute(
+        "SELECT subject, body FROM campaigns WHERE id = ?", (campaign_id,)
+    ).fetchone()
+    recipients = load_recipients(recipient_ids, conn)
+    conn.execute("UPDATE jobs SET status = 'RUNNING', total = ? WHERE id = ?", (len(recipients), job_id))
+
+    render = compile_template(body)
+    # Generador: cada cuerpo personalizado se construye justo antes de enviarlo
+    messages = ((email, subject, render(name)) for _, email, name in recipients)
+    sent_ok = 0
+    log_rows = []
+    try:
+        for i, ((contact_id, email, _), (ok, err)) in enumerate(
+            zip(recipients, send_bulk_smtp(messages)), start=1
+        ):
+            status = "SENT" if ok else "ERROR"
+            log_rows.append((campaign_id, contact_id, email, status, err, datetime.utcnow().isoformat()))
+            if ok: sent_ok += 1
+            # Vuelca los logs por lotes en lugar de un commit por destinatario
+            if len(log_rows) >= LOG_BATCH_SIZE:
+                log_sends(log_rows, conn)
+                log_rows = []
+            if i % JOB_PROGRESS_EVERY == 0:
+                conn.execute(
+                    "UPDATE jobs SET processed = ?, sent_ok = ? WHERE id = ?", (i, sent_ok, job_id)
+                )
+    finally:
+        # Aunque el trabajo falle, los correos ya entregados deben quedar registrados
+        # en sends antes de que send_worker lo marque como ERROR
+        log_sends(log_rows, conn)
+    conn.execute(
+        "UPDATE jobs SET status = 'DONE', processed = ?, sent_ok = ?, finished_at = ? WHERE id = ?",
+        (len(recipients), sent_ok, datetime.utcnow().isoformat(), job_id)
+    )
+
+def send_worker(jobs):
+    # Conexión propia: las transacciones del worker no se mezclan con las de la UI
+    conn = connect_db()
+    while True:
+        job_id, campaign_id, recipient_ids = jobs.get()
+        try:
+            run_send_job(conn, job_id, campaign_id, recipient_ids)
+        except Exception as e:
+            # Marcar el error nunca debe tumbar el worker (p. ej. "database is locked"):
+            # si el hilo muriera, los trabajos siguientes quedarían en QUEUED para siempre.
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute(
+                    "UPDATE jobs SET status = 'ERROR', error = ?, finished_at = ? WHERE id = ?",
+                    (str(e), datetime.utcnow().isoformat(), job_id)
+                )
+            except Exception:
+                pass
+        finally:
+            jobs.task_done()
+
+@st.cache_resource
+def get_job_queue():
+    # Un solo worker por proceso del servidor, compartido entre reruns y sesiones
+    jobs = queue.Queue()
+    threading.Thread(target=send_worker, args=(jobs,), daemon=True).start()
+    return jobs
 
 # -------------- UI --------------------
 def page_contacts():
@@ -143,38 +669,39 @@ def page_contacts():
             if submitted:
                 if not email:
                     st.error("El email es obligatorio.")
+                elif not EMAIL_RE.match(email.strip()):
+                    st.error("El email no es válido.")
                 else:
                     insert_contact(name, email, tags)
                     st.success(f"Contacto '{email}' guardado (o ya existía).")
-                    # Actualiza la tabla inmediatamente
-                    with get_conn() as conn:
-                        st.session_state["contacts_df"] = pd.read_sql_query(
-                            "SELECT * FROM contacts ORDER BY id DESC", conn
-                        )
 
     st.divider()
     st.subheader("📤 Importar desde CSV")
     st.caption("El CSV debe tener columnas: email, name (opcional), tags (opcional).")
     file = st.file_uploader("Subir CSV", type=["csv"])
     if file:
-        df = pd.read_csv(file)
-        st.dataframe(df.head(20))
+        # Solo la vista previa pasa por pandas
+        st.dataframe(pd.read_csv(file, nrows=20))
         if st.button("Importar contactos"):
-            count = bulk_import_contacts(df)
-            st.success(f"Importados {count} contactos.")
-            # Actualiza la tabla después de importar
-            with get_conn() as conn:
-                st.session_state["contacts_df"] = pd.read_sql_query(
-                    "SELECT * FROM contacts ORDER BY id DESC", conn
-                )
+            file.seek(0)
+            try:
+                count, rejected = bulk_import_contacts(file)
+            except UnicodeDecodeError:
+                # La vista previa solo decodifica 20 filas; la importación ya hizo rollback
+                st.error("El CSV debe estar codificado en UTF-8 (no se importó ningún contacto).")
+            else:
+                st.success(f"Importados {count} contactos.")
+                if rejected:
+                    st.warning(f"{rejected} filas descartadas por email inválido.")
 
     st.divider()
-    df_contacts = st.session_state.get("contacts_df")
-    if df_contacts is None:
-        with get_conn() as conn:
-            df_contacts = pd.read_sql_query("SELECT * FROM contacts ORDER BY id DESC", conn)
-            st.session_state["contacts_df"] = df_contacts
-    st.subheader(f"📋 Listado de contactos ({len(df_contacts)})")
+    # Se lee después de las escrituras de arriba: el mtime nuevo invalida la caché
+    mtime = db_mtime()
+    total = count_contacts(mtime)
+    st.subheader(f"📋 Listado de contactos ({total})")
+    last_page = max((total - 1) // CONTACTS_PAGE_SIZE, 0)
+    page = st.number_input("Página", min_value=0, max_value=last_page, step=1)
+    df_contacts = load_contacts_page(mtime, int(page))
     st.dataframe(df_contacts, use_container_width=True)
 
 
@@ -189,29 +716,24 @@ def page_campaigns():
         submitted = st.form_submit_button("Crear campaña")
         if submitted:
             if subject and body:
-                insert_campaign(subject, body)
-                st.success("Campaña creada.")
+                campaign_id = insert_campaign(subject, body)
+                st.success(f"Campaña #{campaign_id} creada.")
             else:
                 st.error("Asunto y contenido son obligatorios.")
 
     st.divider()
-    with get_conn() as conn:
-        df_campaigns = pd.read_sql_query("SELECT * FROM campaigns ORDER BY id DESC", conn)
-    st.session_state["campaigns_df"] = df_campaigns
+    # Se lee después del insert: el mtime nuevo invalida la caché
+    df_campaigns = load_campaigns(db_mtime())
     st.subheader(f"📚 Borradores ({len(df_campaigns)})")
     st.dataframe(df_campaigns, use_container_width=True)
 
 
 def page_send():
     st.header("🚀 Enviar campaña")
-    df_campaigns = st.session_state.get("campaigns_df")
-    df_contacts = st.session_state.get("contacts_df")
+    mtime = db_mtime()
+    df_campaigns = load_campaigns(mtime)
 
-    if df_campaigns is None or df_contacts is None:
-        st.warning("Debes crear al menos una campaña y agregar contactos.")
-        return
-
-    if df_campaigns.empty or df_contacts.empty:
+    if df_campaigns.empty or count_contacts(mtime) == 0:
         st.warning("Debes crear al menos una campaña y agregar contactos.")
         return
 
@@ -221,12 +743,26 @@ def page_send():
         format_func=lambda r: f"[{r.id}] {r.subject}"
     )
 
-    recipients = st.multiselect(
-        "Destinatarios",
-        options=df_contacts.itertuples(),
-        default=list(df_contacts.itertuples()),
-        format_func=lambda r: f"{r.email} ({r.name})" if r.name else r.email
-    )
+    # Destinatarios como filtro por etiquetas resuelto en SQL (cacheado por mtime):
+    # en cada rerun solo se leen la lista de etiquetas y un conteo.
+    selected_tags = tuple(st.multiselect("Filtrar por etiquetas (vacío = todos)", load_tags(mtime)))
+    n_targets = count_targets(mtime, selected_tags)
+    send_all = st.checkbox(f"Enviar a todos los que coinciden ({n_targets})", value=True)
+    # Solo IDs viajan al frontend; email/nombre se resuelven en bloque al enviar
+    if send_all:
+        recipient_ids = None
+    else:
+        label_by_id = load_target_labels(mtime, selected_tags)
+        if n_targets > RECIPIENT_PICKER_LIMIT:
+            st.caption(
+                f"Mostrando los {RECIPIENT_PICKER_LIMIT} contactos más recientes de {n_targets}; "
+                "filtra por etiquetas para acotar la lista."
+            )
+        recipient_ids = st.multiselect(
+            "Destinatarios",
+            options=list(label_by_id),
+            format_func=label_by_id.get
+        )
 
     test_email = st.text_input("Enviar prueba a (opcional)")
     col1, col2 = st.columns(2)
@@ -234,16 +770,10 @@ def page_send():
     with col1:
         if st.button("Enviar PRUEBA"):
             if test_email:
-                body = campaign.body.replace("{{name}}", "Prueba")
+                body = compile_template(campaign.body)("Prueba")
                 ok, err = send_email_smtp(test_email, campaign.subject, body)
                 status = "SENT" if ok else "ERROR"
                 log_send(campaign.id, None, test_email, status, err)
-                with get_conn() as conn:
-                    st.session_state["sends_df"] = pd.read_sql_query(
-                        "SELECT s.id, s.sent_at, s.status, s.error, s.email, c.subject "
-                        "FROM sends s LEFT JOIN campaigns c ON s.campaign_id = c.id "
-                        "ORDER BY s.id DESC LIMIT 500", conn
-                    )
                 if ok:
                     st.success("Prueba enviada (o simulada).")
                 else:
@@ -253,44 +783,49 @@ def page_send():
 
     with col2:
         if st.button("Enviar a TODOS los seleccionados"):
-            sent_ok = 0
-            for r in recipients:
-                personalized = campaign.body.replace("{{name}}", r.name or "")
-                ok, err = send_email_smtp(r.email, campaign.subject, personalized)
-                status = "SENT" if ok else "ERROR"
-                log_send(campaign.id, r.id, r.email, status, err)
-                if ok: sent_ok += 1
-            with get_conn() as conn:
-                st.session_state["sends_df"] = pd.read_sql_query(
-                    "SELECT s.id, s.sent_at, s.status, s.error, s.email, c.subject "
-                    "FROM sends s LEFT JOIN campaigns c ON s.campaign_id = c.id "
-                    "ORDER BY s.id DESC LIMIT 500", conn
-                )
-            st.success(f"Proceso finalizado. Enviados OK: {sent_ok}/{len(recipients)} (simulados).")
+            # El envío corre en el worker de fondo; la UI solo encola y consulta el progreso
+            if recipient_ids is None:
+                recipient_ids = load_target_ids(mtime, selected_tags)
+            if not recipient_ids:
+                st.warning("No hay destinatarios seleccionados.")
+            else:
+                job_id = insert_job(campaign.id, len(recipient_ids))
+                get_job_queue().put((job_id, campaign.id, recipient_ids))
+                st.session_state["job_id"] = job_id
+
+    job_id = st.session_state.get("job_id")
+    if job_id is not None:
+        job = load_job(job_id)
+        if job is not None and job[0] not in JOB_FINAL_STATUSES:
+            poll_job_progress(job_id)
+        else:
+            # Trabajo terminado: se muestra el resultado una vez, sin seguir consultando
+            del st.session_state["job_id"]
+            if job is not None:
+                show_job(job_id, job)
+
+
+def show_job(job_id, job):
+    status, total, processed, sent_ok, error = job
+    st.progress(processed / total if total else 1.0, text=f"Envío #{job_id}: {processed}/{total}")
+    if status == "DONE":
+        simulated = "" if smtp_configured() else " (simulados)"
+        st.success(f"Proceso finalizado. Enviados OK: {sent_ok}/{total}{simulated}.")
+    elif status == "ERROR":
+        st.error(f"Error en el envío: {error}")
+
+
+@st.fragment(run_every=2)
+def poll_job_progress(job_id):
+    job = load_job(job_id)
+    if job is None or job[0] in JOB_FINAL_STATUSES:
+        # Rerun completo: page_send pinta el resultado final y el fragment deja de existir
+        st.rerun()
+    show_job(job_id, job)
 
 
 def main():
-    init_db()
-
-    if "contacts_df" not in st.session_state:
-        with get_conn() as conn:
-            st.session_state["contacts_df"] = pd.read_sql_query(
-                "SELECT * FROM contacts ORDER BY id DESC", conn
-            )
-
-    if "campaigns_df" not in st.session_state:
-        with get_conn() as conn:
-            st.session_state["campaigns_df"] = pd.read_sql_query(
-                "SELECT * FROM campaigns ORDER BY id DESC", conn
-            )
-
-    if "sends_df" not in st.session_state:
-        with get_conn() as conn:
-            st.session_state["sends_df"] = pd.read_sql_query(
-                "SELECT s.id, s.sent_at, s.status, s.error, s.email, c.subject "
-                "FROM sends s LEFT JOIN campaigns c ON s.campaign_id = c.id "
-                "ORDER BY s.id DESC LIMIT 500", conn
-            )
+    init_db_once()
 
     st.sidebar.title("Mini-Brevo (Local Demo)")
     page = st.sidebar.radio("Menú", ["Contactos", "Campañas", "Enviar", "Logs"])
@@ -303,7 +838,8 @@ def main():
         page_send()
     else:
         st.header("📈 Historial de envíos")
-        df = st.session_state.get("sends_df")
+        # Cacheado por mtime de la DB: sin escrituras nuevas no se consulta SQLite
+        df = load_sends(db_mtime())
         st.dataframe(df, use_container_width=True)
         st.caption("Nota: En modo demo, los envíos se simulan si no configuras SMTP.")
 